@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# 测试公共夹具：本地 HTTP 服务器，模拟 wallhaven 接口和图片 CDN
+
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wall_haven  # noqa: E402
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.server.hits.append(path)
+        route = self.server.routes.get(path)
+        if route is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        route(self)
+
+    def log_message(self, *args):
+        pass
+
+
+def send_body(handler, body, status=200, headers=None):
+    handler.send_response(status)
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    """
+    本地 HTTP 服务器，routes 为 路径 -> 处理函数(handler)，hits 记录所有请求路径
+    """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    httpd.daemon_threads = True
+    httpd.routes = {}
+    httpd.hits = []
+    httpd.base_url = f'http://127.0.0.1:{httpd.server_address[1]}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch, tmp_path):
+    """
+    每个测试在临时目录运行，不走代理，不受接口限速影响，使用独立的缓存文件
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(wall_haven, 'proxies', {})
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1,localhost')
+    monkeypatch.setattr(wall_haven, 'API_LIMITER', wall_haven.RateLimiter(60000))
+    monkeypatch.setattr(wall_haven, '_SEEN_IDS', {})
+    monkeypatch.setattr(wall_haven, 'DETAILS_CACHE', wall_haven.ShelfCache(str(tmp_path / 'details')))
+    monkeypatch.setattr(wall_haven, 'CONDITIONAL_CACHE', wall_haven.ShelfCache(
+        str(tmp_path / 'conditional'), on_open=wall_haven._prune_conditional_cache))
+    wall_haven._fetch_wallpaper_details.cache_clear()
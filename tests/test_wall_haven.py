@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# wall_haven.py 的测试：流水线去重与退出、条件请求缓存、下载失败清理
+
+import os
+import shelve
+import threading
+import time
+
+import pytest
+
+import wall_haven
+from conftest import send_body
+
+
+def _image_route(body):
+    return lambda handler: send_body(handler, body, headers={'Content-Type': 'image/jpeg'})
+
+
+def test_pipeline_deduplicates_and_shuts_down(server, tmp_path, monkeypatch):
+    server.routes['/img/a.jpg'] = _image_route(b'a' * 1000)
+    server.routes['/img/b.jpg'] = _image_route(b'b' * 2000)
+    # 纯ID 'b' 需要查询详情，'c' 详情查询失败，'d' 图片不存在
+    details = {'b': f'{server.base_url}/img/b.jpg', 'c': None, 'd': f'{server.base_url}/img/missing.jpg'}
+    monkeypatch.setattr(wall_haven, 'get_wallpaper_details', details.get)
+
+    batches = [
+        [('a', f'{server.base_url}/img/a.jpg'), ('a', f'{server.base_url}/img/a.jpg'), 'b'],
+        [('a', f'{server.base_url}/img/a.jpg'), 'b', 'c', 'd'],
+    ]
+    result = []
+    runner = threading.Thread(target=lambda: result.append(
+        wall_haven.download_wallpapers_concurrently(batches, str(tmp_path), max_workers=3, resolve_workers=2)))
+    runner.start()
+    runner.join(timeout=30)
+
+    assert not runner.is_alive(), "流水线未能退出"
+    assert result == [['a', 'b', 'c', 'd']]
+    assert server.hits.count('/img/a.jpg') == 1
+    assert server.hits.count('/img/b.jpg') == 1
+    assert (tmp_path / 'a.jpg').read_bytes() == b'a' * 1000
+    assert (tmp_path / 'b.jpg').read_bytes() == b'b' * 2000
+    assert not (tmp_path / 'missing.jpg').exists()
+    assert (tmp_path / 'wallpaper_ids.txt').read_text().split() == ['a', 'b', 'c', 'd']
+
+
+def test_pipeline_skips_existing_files(server, tmp_path):
+    server.routes['/img/a.jpg'] = _image_route(b'new')
+    (tmp_path / 'a.jpg').write_bytes(b'old')
+
+    wall_haven.download_wallpapers_concurrently([[('a', f'{server.base_url}/img/a.jpg')]], str(tmp_path))
+
+    assert server.hits == []
+    assert (tmp_path / 'a.jpg').read_bytes() == b'old'
+
+
+def test_fetch_api_data_returns_cached_result_on_304(server):
+    body = b'{"data": [{"id": "a", "path": "https://w.wallhaven.cc/full/a.jpg", "views": 1}]}'
+    if_none_match = []
+
+    def search(handler):
+        if_none_match.append(handler.headers.get('If-None-Match'))
+        if handler.headers.get('If-None-Match') == '"v1"':
+            handler.send_response(304)
+            handler.send_header('ETag', '"v1"')
+            handler.end_headers()
+        else:
+            send_body(handler, body, headers={'ETag': '"v1"', 'Content-Type': 'application/json'})
+
+    server.routes['/api/v1/search'] = search
+    url = f'{server.base_url}/api/v1/search'
+
+    first = wall_haven.fetch_api_data(url, {'q': 'x'}, wall_haven.parse_search_response)
+    second = wall_haven.fetch_api_data(url, {'q': 'x'}, wall_haven.parse_search_response)
+
+    assert first == second == [('a', 'https://w.wallhaven.cc/full/a.jpg')]
+    assert if_none_match == [None, '"v1"']
+
+
+def test_fetch_api_data_treats_undecodable_body_as_failure(server):
+    server.routes['/api/v1/search'] = lambda handler: send_body(handler, b'<html>maintenance</html>')
+
+    assert wall_haven.fetch_api_data(f'{server.base_url}/api/v1/search', {},
+                                     wall_haven.parse_search_response) is None
+
+
+def test_conditional_cache_drops_stale_entries(tmp_path):
+    filename = str(tmp_path / 'conditional_stale')
+    stale_time = time.time() - wall_haven.CONDITIONAL_CACHE_MAX_AGE - 1
+    with shelve.open(filename) as shelf:
+        shelf['stale'] = ('"v1"', None, [], stale_time)
+        shelf['fresh'] = ('"v2"', None, [], time.time())
+        shelf['old_format'] = ('"v3"', None, [])
+
+    cache = wall_haven.ShelfCache(filename, on_open=wall_haven._prune_conditional_cache)
+
+    assert cache.get('stale') is None
+    assert cache.get('old_format') is None
+    assert cache.get('fresh') is not None
+
+
+def test_download_image_removes_file_when_connection_drops(server, tmp_path):
+    def truncated(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', '100000')
+        handler.end_headers()
+        handler.wfile.write(b'x' * 1000)
+        handler.close_connection = True
+
+    server.routes['/img/broken.jpg'] = truncated
+    filename = str(tmp_path / 'broken.jpg')
+
+    with pytest.raises(Exception):
+        wall_haven.download_image(f'{server.base_url}/img/broken.jpg', filename, show_progress=False)
+
+    assert not os.path.exists(filename)
+
+
+def test_download_image_removes_file_on_read_timeout(server, tmp_path, monkeypatch):
+    released = threading.Event()
+
+    def stalled(handler):
+        handler.send_response(200)
+        handler.send_header('Content-Length', '100000')
+        handler.end_headers()
+        handler.wfile.write(b'x' * 1000)
+        handler.wfile.flush()
+        released.wait(5)
+
+    server.routes['/img/stalled.jpg'] = stalled
+    monkeypatch.setattr(wall_haven, 'REQUEST_TIMEOUT', (1, 0.5))
+    filename = str(tmp_path / 'stalled.jpg')
+
+    try:
+        with pytest.raises(Exception):
+            wall_haven.download_image(f'{server.base_url}/img/stalled.jpg', filename, show_progress=True)
+    finally:
+        released.set()
+
+    assert not os.path.exists(filename)
@@ -8,33 +8,108 @@
 
 
 import time
-import random
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import os
 import json
-from concurrent.futures import ThreadPoolExecutor
+import shutil
+import atexit
+import shelve
+import functools
+import hashlib
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 from urllib.parse import urlparse, parse_qs
 
+# 优先使用 orjson 解析 JSON（C 实现，更快），未安装时退回标准库
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # 配置日志记录
 logging.basicConfig(filename='wallhaven.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class TqdmLoggingHandler(logging.Handler):
+    """
+    通过 tqdm.write 输出日志到屏幕，不会打断正在显示的进度条
+    """
+
+    def emit(self, record):
+        try:
+            tqdm.write(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+# 日志完整写入文件，屏幕只显示警告和错误，进度由 tqdm 显示
+_console_handler = TqdmLoggingHandler(level=logging.WARNING)
+_console_handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+logger.addHandler(_console_handler)
 
 proxies = {
     'http': '127.0.0.1:18081',
     'https': '127.0.0.1:18081',
 }
 
-# 加载配置文件
-with open("config.json", 'r') as f:
-    config = json.load(f)
-    api_key = config['sites']['wallhaven']['api_key']
-
-
-# 统一日志记录和屏幕输出
-def log_and_print(message, level=logging.INFO):
-    logging.log(level, message)
-    print(message)
+# 下载并发数，图片 CDN 的连接池大小与之匹配，保证每个下载线程都能复用已有连接
+MAX_WORKERS = 10
+# 分页获取壁纸ID时的并发数
+PAGE_WORKERS = 4
+# 流水线中解析原图URL的线程数
+RESOLVE_WORKERS = 4
+
+# 全局共享会话，复用 TCP/TLS 连接（keep-alive + 连接池）
+# 接口连接池大小与分页、解析原图URL的线程总数匹配
+# 连接错误和 5xx 由 urllib3 的 Retry 自动重试；接口的 429 交给 make_request 处理，以便暂停全局限速器
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=PAGE_WORKERS + RESOLVE_WORKERS, max_retries=Retry(
+    total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], respect_retry_after_header=False))
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+# 图片 CDN 单独使用一个连接池，整个批次内保持长连接，429 也直接由 Retry 处理
+_image_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS, max_retries=Retry(
+    total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]))
+SESSION.mount('https://w.wallhaven.cc', _image_adapter)
+SESSION.headers['User-Agent'] = 'PyPicFetcher/1.0 (+https://wallhaven.cc/help/api)'
+
+# 请求超时（连接超时, 读取超时），单位秒；超时后由 Retry 重试，不会无限阻塞
+REQUEST_TIMEOUT = (10, 30)
+
+# 下载时每次读取的块大小与文件写缓冲大小
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# 壁纸详情持久化缓存文件（pic_id -> 原图URL），跨运行复用
+DETAILS_CACHE_FILE = 'wallpaper_details'
+# 接口条件请求持久化缓存文件（请求键 -> (ETag, Last-Modified, 解析结果, 写入时间)），跨运行复用
+CONDITIONAL_CACHE_FILE = 'api_conditional_cache'
+# 条件请求缓存条目的最长保留时间（秒），超过后在打开缓存时清理
+CONDITIONAL_CACHE_MAX_AGE = 7 * 24 * 3600
+
+# wallhaven 接口限速：每分钟最多 45 次请求
+API_RATE_LIMIT = 45
+# 流水线各阶段之间队列的容量
+PIPELINE_QUEUE_SIZE = 64
+
+# 搜索接口地址，apikey 通过查询参数传递
+BASE_SEARCH_URL = 'https://wallhaven.cc/api/v1/search'
+
+# 加载配置文件，文件不存在时不使用 apikey
+try:
+    with open("config.json", 'rb') as f:
+        config = json_loads(f.read())
+        api_key = config['sites']['wallhaven']['api_key']
+except FileNotFoundError:
+    api_key = ""
 
 
 # 解析URL参数
@@ -44,184 +119,518 @@ def parse_url_params(_url):
     return {k: v[0] if len(v) == 1 else v for k, v in _params.items()}
 
 
+# 解析接口响应，搜索结果已包含原图URL（path），无需再逐个请求详情接口
+# 安装了 msgspec 时按结构体只解码需要的字段，跳过其余字段
+try:
+    import msgspec
+
+    class Wallpaper(msgspec.Struct):
+        id: str
+        path: str
+
+    class SearchResp(msgspec.Struct):
+        data: list[Wallpaper]
+
+    class WallpaperDetail(msgspec.Struct):
+        path: str
+
+    class DetailResp(msgspec.Struct):
+        data: WallpaperDetail
+
+    _search_decoder = msgspec.json.Decoder(SearchResp)
+    _detail_decoder = msgspec.json.Decoder(DetailResp)
+
+    def parse_search_response(content):
+        return [(wallpaper.id, wallpaper.path) for wallpaper in _search_decoder.decode(content).data]
+
+    def parse_detail_response(content):
+        return _detail_decoder.decode(content).data.path
+
+    # 响应体不是合法 JSON 或缺少所需字段时抛出的异常
+    DECODE_ERRORS = (ValueError, msgspec.DecodeError, msgspec.ValidationError)
+except ImportError:
+    def parse_search_response(content):
+        return [(wallpaper['id'], wallpaper['path']) for wallpaper in json_loads(content)['data']]
+
+    def parse_detail_response(content):
+        return json_loads(content)['data']['path']
+
+    # 响应体不是合法 JSON 或缺少所需字段时抛出的异常
+    DECODE_ERRORS = (ValueError, KeyError, TypeError)
+
+
 # 获取壁纸ID的通用函数
 def fetch_wallpaper_ids_single(base_url, _params):
     """
     处理单次请求以获取壁纸ID
     :param base_url: 基础URL
     :param _params: 查询条件
-    :return: 壁纸ID列表
+    :return: (壁纸ID, 原图URL) 列表
     """
-    pic_ids = []
-    _response = make_request(base_url, _params)
+    wallpapers = []
+    search_results = fetch_api_data(base_url, _params, parse_search_response)
 
-    if _response.status_code == 200:
-        data = _response.json()
-        wallpapers = data['data']
+    if search_results is not None:
+        wallpapers.extend(search_results)
 
-        pic_ids.extend([wallpaper['id'] for wallpaper in wallpapers])
-
-        log_and_print("壁纸 ID 获取成功.")
+        logger.info("壁纸 ID 获取成功.")
     else:
-        log_and_print(f"请求失败，状态码：{_response.status_code}", logging.ERROR)
+        logger.error("壁纸 ID 获取失败.")
 
-    return pic_ids
+    return wallpapers
 
 
-def fetch_wallpaper_ids_paginated(base_url, _params, start_page, end_page):
+class RateLimiter:
     """
-    处理分页请求以获取壁纸ID
-    :param base_url: 基础URL
-    :param _params: 查询条件
-    :param start_page: 起始页码
-    :param end_page: 结束页码
-    :return: 壁纸ID列表
+    全局限速器，多线程共享，按固定间隔放行请求，只在需要时阻塞
     """
-    pic_ids = []
 
-    for _page in range(start_page, end_page + 1):
-        _params['page'] = _page  # 更新页码参数
-        _response = make_request(base_url, _params)
+    def __init__(self, max_per_minute):
+        self._interval = 60.0 / max_per_minute
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
 
-        if _response.status_code == 200:
-            data = _response.json()
-            wallpapers = data['data']
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(self._next_time, now) + self._interval
+        if wait_time > 0:
+            time.sleep(wait_time)
 
-            pic_ids.extend([wallpaper['id'] for wallpaper in wallpapers])
+    def pause(self, seconds):
+        """收到 429 时暂停放行，seconds 通常来自 Retry-After 响应头"""
+        with self._lock:
+            self._next_time = max(self._next_time, time.monotonic() + seconds)
 
-            log_and_print(f"第 {_page} 页的壁纸 ID 获取成功.")
-        else:
-            log_and_print(f"请求第 {_page} 页时失败，状态码：{_response.status_code}", logging.ERROR)
 
-        # 增加请求间隔
-        time.sleep(random.uniform(1.2, 1.5))
+# wallhaven 接口的全局限速器
+API_LIMITER = RateLimiter(API_RATE_LIMIT)
 
-    return pic_ids
 
+def _fetch_wallpaper_ids_page(base_url, _params, _page):
+    """
+    获取单页壁纸ID
+    :param base_url: 基础URL
+    :param _params: 查询条件
+    :param _page: 页码
+    :return: (页码, (壁纸ID, 原图URL) 列表)
+    """
+    page_params = dict(_params, page=_page)  # 每页使用独立的参数副本，避免并发修改
+    page_wallpapers = fetch_api_data(base_url, page_params, parse_search_response)
 
-def get_wallpaper_ids(_params, **kwargs):
+    if page_wallpapers is not None:
+        logger.info("第 %d 页的壁纸 ID 获取成功.", _page)
+        return _page, page_wallpapers
+
+    logger.error("请求第 %d 页时失败", _page)
+    return _page, []
+
+
+def iter_wallpaper_pages(base_url, _params, start_page, end_page, max_workers=PAGE_WORKERS):
     """
-    获取指定查询条件下的壁纸ID
+    多页并发请求，按完成顺序逐页产出结果
+    :param base_url: 基础URL
+    :param _params: 查询条件
+    :param start_page: 起始页码
+    :param end_page: 结束页码
+    :param max_workers: 最大并发数
+    :return: 生成器，产出 (页码, (壁纸ID, 原图URL) 列表)
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_fetch_wallpaper_ids_page, base_url, _params, _page)
+                   for _page in range(start_page, end_page + 1)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def iter_wallpaper_batches(_params, start_page=None, end_page=None):
+    """
+    获取指定查询条件下的壁纸，单次请求和分页请求统一逐批产出
     :param _params: 查询条件（例如 'id:148879' 或其它条件）
-    :param kwargs: 可选参数，包括 start_page 和 end_page
-    :return: 壁纸ID列表
+    :param start_page: 起始页码，为 None 时只请求一次
+    :param end_page: 结束页码
+    :return: 生成器，逐批产出 (壁纸ID, 原图URL) 列表，分页时按完成顺序产出
     """
-    base_url = f'https://wallhaven.cc/api/v1/search?apikey={api_key}'
+    # 补充 apikey（未配置时不添加）
+    if api_key:
+        _params.setdefault('apikey', api_key)
 
-    # 检查是否提供了 start_page 和 end_page
-    if 'start_page' in kwargs and 'end_page' in kwargs:
-        start_page = kwargs['start_page']
-        end_page = kwargs['end_page']
-        pic_ids = fetch_wallpaper_ids_paginated(base_url, _params, start_page, end_page)
+    if start_page is None:
+        yield fetch_wallpaper_ids_single(BASE_SEARCH_URL, _params)
     else:
-        pic_ids = fetch_wallpaper_ids_single(base_url, _params)
+        for _page, page_wallpapers in iter_wallpaper_pages(BASE_SEARCH_URL, _params, start_page, end_page):
+            yield page_wallpapers
+
+
+class ShelfCache:
+    """
+    基于 shelve 的持久化缓存，首次访问时才打开文件，进程退出时关闭
+    shelve 非线程安全，所有读写都在内部锁内完成
+    """
+
+    def __init__(self, filename, on_open=None):
+        self.filename = filename
+        self._on_open = on_open  # 打开文件后调用，可用于清理过期条目
+        self._lock = threading.Lock()
+        self._shelf = None
+
+    def _get_shelf(self):
+        if self._shelf is None:
+            self._shelf = shelve.open(self.filename)
+            atexit.register(self._shelf.close)
+            if self._on_open is not None:
+                self._on_open(self._shelf)
+        return self._shelf
+
+    def get(self, key):
+        with self._lock:
+            return self._get_shelf().get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._get_shelf()[key] = value
+
+
+# 壁纸详情缓存
+DETAILS_CACHE = ShelfCache(DETAILS_CACHE_FILE)
+
+
+# 获取壁纸详情URL，先查进程内 LRU 缓存，再查磁盘缓存，最后请求接口
+# 请求失败时抛出异常，lru_cache 不会缓存失败结果
+@functools.lru_cache(maxsize=4096)
+def _fetch_wallpaper_details(pic_id):
+    original_image_url = DETAILS_CACHE.get(pic_id)
+    if original_image_url:
+        return original_image_url
+
+    # 经 make_request 统一限速并处理 429，失败时抛出异常，避免失败结果被缓存
+    response = make_request(f"https://wallhaven.cc/api/v1/w/{pic_id}")
+    if response is None:
+        raise requests.exceptions.RequestException("请求失败，已放弃")
+    original_image_url = parse_detail_response(response.content)
 
-    return pic_ids
+    DETAILS_CACHE.set(pic_id, original_image_url)
+    return original_image_url
 
 
 # 获取壁纸详情URL
 def get_wallpaper_details(pic_id):
     try:
-        response = requests.get(f"https://wallhaven.cc/api/v1/w/{pic_id}")
-        if response is None:
-            raise ValueError("请求返回为空")
-        if response.status_code == 200:
-            data = response.json()
-            original_image_url = data['data']['path']
-            return original_image_url
-        else:
-            response.raise_for_status()  # 抛出HTTPError异常
+        return _fetch_wallpaper_details(pic_id)
     except requests.exceptions.RequestException as e:
-        print(f"请求失败: {e}")
+        logger.error("壁纸 %s 获取详情失败: %s", pic_id, e)
+        return None
+    except DECODE_ERRORS as e:
+        logger.error("壁纸 %s 详情解析失败: %s", pic_id, e)
         return None
 
 
+# 按 Content-Length 预分配文件空间，便于文件系统分配连续的块
+def preallocate_file(f, size):
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except AttributeError:
+        # Windows 没有 posix_fallocate，直接扩展文件大小
+        f.truncate(size)
+        f.seek(0)
+    except OSError:
+        pass  # 文件系统不支持预分配，忽略
+
+
 # 下载图片并显示进度条
-def download_image(image_url, filename):
-    _response = make_request(image_url, stream=True)
-
-    if _response.status_code == 200:
-        total_size = int(_response.headers.get('content-length', 0))  # 获取图片总大小
-        with open(filename, 'wb') as f:
-            # 使用 tqdm 显示下载进度条
-            for chunk in tqdm(_response.iter_content(1024), total=total_size // 1024, unit='KB', desc=filename):
-                if chunk:
-                    f.write(chunk)
-
-        # 下载完成后记录图片大小
-        file_size_mb = total_size / (1024 * 1024)
-        log_and_print(f"图片已保存为 {filename}，大小：{file_size_mb:.2f} MB")
-    else:
-        log_and_print(f"下载失败: {image_url}", logging.ERROR)
+def download_image(image_url, filename, show_progress=True):
+    # 图片由 CDN 提供，不计入接口限速
+    _response = make_request(image_url, stream=True, rate_limited=False)
+
+    if _response is None:
+        logger.error("下载失败: %s", image_url)
+        return False
+
+    # 使用 with 确保流式响应被关闭，连接归还连接池
+    with _response:
+        if _response.status_code == 200:
+            total_size = int(_response.headers.get('content-length', 0))  # 获取图片总大小
+            # 直接从底层响应流复制到文件，避免逐块在 Python 层循环
+            _response.raw.decode_content = True
+            try:
+                with open(filename, 'wb', buffering=DOWNLOAD_BUFFER_SIZE) as f:
+                    if total_size:
+                        preallocate_file(f, total_size)
+                    if show_progress:
+                        # 使用 tqdm 显示下载进度条，包装 read 方法按实际字节数更新
+                        with tqdm(total=total_size, unit='B', unit_scale=True, miniters=1, desc=filename) as pbar:
+                            source = CallbackIOWrapper(pbar.update, _response.raw, 'read')
+                            shutil.copyfileobj(source, f, length=DOWNLOAD_CHUNK_SIZE)
+                    else:
+                        shutil.copyfileobj(_response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                    # 实际写入长度可能与 Content-Length 不同，按当前位置截断多余的预分配空间
+                    f.truncate()
+            except BaseException:
+                # 下载中断时删除不完整的文件，否则下次运行会把它当作已下载而跳过
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                raise
+
+            # 下载完成后记录图片大小
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("图片已保存为 %s，大小：%.2f MB", filename, total_size / (1024 * 1024))
+            return True
+        else:
+            logger.error("下载失败: %s", image_url)
+            return False
+
+
+# 已保存的壁纸ID（按文件名区分），首次保存时从文件加载一次，之后只在内存中合并
+_SEEN_IDS = {}
 
 
 # 保存壁纸ID到文件
 def save_wallpaper_ids_to_file(pic_ids, filename='wallpaper_ids.txt'):
-    # 读取文件内容，检查 wallpaper_id 是否已经存在
-    existing_ids = set()
-    try:
-        with open(filename, 'r') as f:
-            existing_ids = {line.strip() for line in f}
-    except FileNotFoundError:
-        pass  # 文件不存在，无需处理
+    seen_ids = _SEEN_IDS.get(filename)
+    if seen_ids is None:
+        # 读取文件内容，检查 wallpaper_id 是否已经存在
+        seen_ids = set()
+        try:
+            with open(filename, 'r') as f:
+                seen_ids = {line.strip() for line in f}
+        except FileNotFoundError:
+            pass  # 文件不存在，无需处理
+        _SEEN_IDS[filename] = seen_ids
 
+    saved_count = 0
     with open(filename, 'a') as f:
         for wallpaper_id in pic_ids:
-            if wallpaper_id not in existing_ids:
+            if wallpaper_id not in seen_ids:
+                seen_ids.add(wallpaper_id)
                 f.write(f"{wallpaper_id}\n")
-                log_and_print(f"壁纸 ID {wallpaper_id} 已保存到 {filename}")
-            else:
-                log_and_print(f"壁纸 ID {wallpaper_id} 已存在，未保存")
+                saved_count += 1
 
+    logger.info("%d 个壁纸 ID 已保存到 %s，%d 个已存在，未保存", saved_count, filename, len(pic_ids) - saved_count)
 
-# 执行下载任务
-def main(pic_id, directory):
-    original_image_url = get_wallpaper_details(pic_id)
 
-    if original_image_url:
-        log_and_print(f"原图 URL: {original_image_url}")
-        pic_filename = original_image_url.split('/')[-1]
-        pic_filepath = os.path.join(directory, pic_filename)
+# 一次性扫描目录，获取已下载的文件名集合，代替逐个文件检查是否存在
+def scan_existing_files(directory):
+    return {entry.name for entry in os.scandir(directory) if entry.is_file()}
 
-        # 检查文件是否已经存在
-        if os.path.exists(pic_filepath):
-            log_and_print(f"图片 {pic_filename} 已存在，跳过下载。")
-        else:
-            download_image(original_image_url, pic_filepath)
+
+# 补全原图URL，获取失败时记录日志并返回 None
+def resolve_wallpaper_url(pic_id, original_image_url=None):
+    if original_image_url is None:
+        # get_wallpaper_details 自行处理请求和解析错误，失败时返回 None
+        original_image_url = get_wallpaper_details(pic_id)
+        if original_image_url is None:
+            logger.error("壁纸 %s 未能获取原图 URL", pic_id)
+    return original_image_url
+
+
+# 执行下载任务
+def main(pic_id, directory, original_image_url=None, existing=None):
+    original_image_url = resolve_wallpaper_url(pic_id, original_image_url)
+    if not original_image_url:
+        return
+
+    logger.debug("原图 URL: %s", original_image_url)
+    pic_filename = original_image_url.rpartition('/')[2]
+    pic_filepath = os.path.join(directory, pic_filename)
+
+    # 检查文件是否已经存在，未传入预扫描的文件名集合时逐个检查
+    if existing is None:
+        already_downloaded = os.path.exists(pic_filepath)
     else:
-        log_and_print("未能获取原图 URL", logging.ERROR)
+        already_downloaded = pic_filename in existing
 
+    if already_downloaded:
+        logger.debug("图片 %s 已存在，跳过下载。", pic_filename)
+    elif download_image(original_image_url, pic_filepath) and existing is not None:
+        existing.add(pic_filename)
 
-# 并行下载壁纸
-def download_wallpapers_concurrently(pic_ids, directory, max_workers=5):
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(main, wallpaper_id, directory) for wallpaper_id in pic_ids]
-        # 等待所有任务完成
-        for future in futures:
-            future.result()  # 捕获异常
 
+# 生产者：逐批去重、保存ID并放入队列
+def _produce_wallpapers(batches, ids_q, num_consumers, collected):
+    try:
+        for batch in batches:
+            # 边过滤边记录，同一批次内的重复ID也只入队一次
+            new_wallpapers = []
+            for wallpaper in batch:
+                wallpaper_id, image_url = wallpaper if isinstance(wallpaper, tuple) else (wallpaper, None)
+                if wallpaper_id not in collected:
+                    collected[wallpaper_id] = image_url
+                    new_wallpapers.append((wallpaper_id, image_url))
+            if not new_wallpapers:
+                continue
+            save_wallpaper_ids_to_file([wallpaper_id for wallpaper_id, _ in new_wallpapers])
+            for wallpaper in new_wallpapers:
+                ids_q.put(wallpaper)
+    except Exception as e:
+        logger.error("获取壁纸列表失败: %s", e)
+    finally:
+        # 每个消费者一个结束标记
+        for _ in range(num_consumers):
+            ids_q.put(None)
+
+
+# 中间阶段：补全原图URL后放入下载队列
+def _resolve_worker(ids_q, urls_q):
+    while True:
+        wallpaper = ids_q.get()
+        if wallpaper is None:
+            break
+        wallpaper_id, image_url = wallpaper
+        image_url = resolve_wallpaper_url(wallpaper_id, image_url)
+        if image_url is not None:
+            urls_q.put((wallpaper_id, image_url))
+
+
+# 消费者：下载图片，单张失败只记录日志，不影响其余任务
+def _download_worker(urls_q, directory, existing):
+    while True:
+        wallpaper = urls_q.get()
+        if wallpaper is None:
+            break
+        wallpaper_id, image_url = wallpaper
+        try:
+            main(wallpaper_id, directory, image_url, existing)
+        except Exception as e:
+            logger.error("壁纸 %s 下载失败: %s", wallpaper_id, e)
 
-# 通用请求函数，包含重试机制
-def make_request(_url, _params=None, stream=False, retries=3, backoff_factor=0.3):
+
+# 并行下载壁纸：获取壁纸列表、补全原图URL、下载图片三个阶段通过有界队列同时进行
+def download_wallpapers_concurrently(batches, directory, max_workers=MAX_WORKERS,
+                                     resolve_workers=RESOLVE_WORKERS, existing=None):
+    """
+    前一批还在获取时，已获取到的壁纸即可开始下载，下载按完成顺序进行，不会被慢任务阻塞
+    :param batches: 逐批产出壁纸的可迭代对象，每批为 (壁纸ID, 原图URL) 元组或纯壁纸ID组成的列表，
+                    例如 iter_wallpaper_batches() 的返回值，已有现成列表时传入 [wallpapers]
+    :param directory: 下载目录
+    :param max_workers: 下载线程数
+    :param resolve_workers: 补全原图URL的线程数
+    :param existing: 已下载的文件名集合
+    :return: 获取到的壁纸ID列表
+    """
+    if existing is None:
+        existing = scan_existing_files(directory)
+
+    ids_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    urls_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    collected = {}
+
+    producer = threading.Thread(target=_produce_wallpapers, args=(batches, ids_q, resolve_workers, collected))
+    resolvers = [threading.Thread(target=_resolve_worker, args=(ids_q, urls_q)) for _ in range(resolve_workers)]
+    downloaders = [threading.Thread(target=_download_worker, args=(urls_q, directory, existing))
+                   for _ in range(max_workers)]
+
+    for thread in [producer, *resolvers, *downloaders]:
+        thread.start()
+
+    producer.join()
+    for thread in resolvers:
+        thread.join()
+    # 所有URL都已入队后，通知下载线程结束
+    for _ in range(max_workers):
+        urls_q.put(None)
+    for thread in downloaders:
+        thread.join()
+
+    return list(collected)
+
+
+# 解析 Retry-After 响应头（秒数），无法解析时返回 None
+def parse_retry_after(response):
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return None
+
+
+# 通用请求函数，包含限速机制，重试由会话挂载的 HTTPAdapter 完成，这里只处理接口的 429
+def make_request(_url, _params=None, stream=False, retries=3, backoff_factor=0.3, rate_limited=True, headers=None):
     for attempt in range(retries):
         try:
-            response = requests.get(_url, params=_params, proxies=proxies, stream=stream)
+            if rate_limited:
+                API_LIMITER.acquire()
+            response = SESSION.get(_url, params=_params, proxies=proxies, stream=stream, headers=headers,
+                                   timeout=REQUEST_TIMEOUT)
             if response.status_code == 429:
-                wait_time = backoff_factor * (2 ** attempt)
-                log_and_print(f"收到 429 错误，等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
+                response.close()  # 释放连接回连接池
+                wait_time = parse_retry_after(response)
+                if wait_time is None:
+                    wait_time = backoff_factor * (2 ** attempt)
+                logger.warning("收到 429 错误，等待 %s 秒后重试...", wait_time)
+                if rate_limited:
+                    # 暂停全局限速器，所有线程一起等待，而不是各自休眠
+                    API_LIMITER.pause(wait_time)
+                else:
+                    time.sleep(wait_time)
                 continue
             response.raise_for_status()
             return response
         except requests.exceptions.RequestException as e:
-            log_and_print(f"请求失败: {e}", logging.ERROR)
-            if attempt < retries - 1:
-                wait_time = backoff_factor * (2 ** attempt)
-                log_and_print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
-            else:
-                log_and_print(f"请求失败，已重试 {retries} 次，放弃。", logging.ERROR)
-                return None
+            logger.error("请求失败: %s", e)
+            return None
+
+    logger.error("请求失败，已重试 %d 次，放弃。", retries)
+    return None
+
+
+# 清理超过 CONDITIONAL_CACHE_MAX_AGE 未被使用的条件请求缓存，避免缓存文件无限增长
+def _prune_conditional_cache(shelf):
+    expire_before = time.time() - CONDITIONAL_CACHE_MAX_AGE
+    for key in [key for key, entry in shelf.items() if len(entry) < 4 or entry[3] < expire_before]:
+        del shelf[key]
+
+
+# 接口条件请求缓存
+CONDITIONAL_CACHE = ShelfCache(CONDITIONAL_CACHE_FILE, on_open=_prune_conditional_cache)
+
+
+def _conditional_cache_key(_url, _params):
+    raw = repr((_url, sorted((_params or {}).items()))).encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+# 请求 JSON 接口并解析，带条件请求，服务器返回 304 时直接使用缓存的解析结果
+def fetch_api_data(_url, _params, parse):
+    """
+    发送带 If-None-Match / If-Modified-Since 的请求，未修改时无需重新下载和解析响应体
+    :param _url: 接口URL
+    :param _params: 查询条件
+    :param parse: 响应体解析函数
+    :return: 解析结果，请求失败时返回 None
+    """
+    key = _conditional_cache_key(_url, _params)
+    cached = CONDITIONAL_CACHE.get(key)
+    headers = {}
+    if cached is not None:
+        etag, last_modified, data, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+    _response = make_request(_url, _params, headers=headers)
+    if _response is None:
+        return None
+    if _response.status_code == 304 and cached is not None:
+        # 刷新写入时间，仍在使用的条目不会被清理
+        CONDITIONAL_CACHE.set(key, (etag, last_modified, data, time.time()))
+        return data
+    if _response.status_code != 200:
+        logger.error("请求失败，状态码：%s", _response.status_code)
+        return None
+
+    try:
+        data = parse(_response.content)
+    except DECODE_ERRORS as e:
+        logger.error("响应解析失败: %s", e)
+        return None
+    etag = _response.headers.get('ETag')
+    last_modified = _response.headers.get('Last-Modified')
+    if etag or last_modified:
+        CONDITIONAL_CACHE.set(key, (etag, last_modified, data, time.time()))
+    return data
 
 
 if __name__ == '__main__':
@@ -236,8 +645,8 @@ if __name__ == '__main__':
 
     # 解析 URL 参数
     params = parse_url_params(url)
-    log_and_print(f"开始执行 URL: {url} 下载任务......")
-    log_and_print(f"解析的 URL 参数: {params}")
+    logger.info("开始执行 URL: %s 下载任务......", url)
+    logger.info("解析的 URL 参数: %s", params)
 
     # 按照 categories 参数下载到不同的文件夹
     # categories: 分类参数，100/010/001/etc (general/anime/people)
@@ -253,21 +662,22 @@ if __name__ == '__main__':
     local_folder = os.path.join(r"F:\wallhaven", pic_folder)
     if not os.path.exists(local_folder):
         os.makedirs(local_folder)
+    # 预先扫描已下载的图片
+    existing_files = scan_existing_files(local_folder)
 
     if 'page' in params:
         # 直接检查是否提供了 start_page 和 end_page
         start_page = 1
         end_page = int(params['page'])
-        wallpaper_ids = get_wallpaper_ids(params, start_page=start_page, end_page=end_page)
     else:
-        wallpaper_ids = get_wallpaper_ids(params)
+        start_page = end_page = None
 
-    # 将获取到的 wallpaper_id 列表存储到文件
-    log_and_print(f"共获取到 {len(wallpaper_ids)} 张壁纸")
-    save_wallpaper_ids_to_file(wallpaper_ids)
+    # 执行并行下载任务，获取到的 wallpaper_id 会逐页存储到文件，最大下载并发数为 MAX_WORKERS
+    wallpaper_batches = iter_wallpaper_batches(params, start_page, end_page)
+    wallpaper_ids = download_wallpapers_concurrently(wallpaper_batches, local_folder,
+                                                     max_workers=MAX_WORKERS, existing=existing_files)
 
     # 输出获取到的 wallpaper_id 列表
-    log_and_print(f"获取到的 wallpaper_id: {wallpaper_ids}")
-
-    # 执行并行下载任务，最大并发数为5
-    download_wallpapers_concurrently(wallpaper_ids, local_folder, max_workers=5)
+    logger.info("共获取到 %d 张壁纸", len(wallpaper_ids))
+    logger.info("获取到的 wallpaper_id: %s", wallpaper_ids)
+    tqdm.write(f"下载任务完成，共获取到 {len(wallpaper_ids)} 张壁纸")